@@ -18,7 +18,7 @@
 # <https://www.gnu.org/licenses/>.
 
 
-import argparse, datetime, os, sys, hid
+import argparse, datetime, os, struct, sys, hid
 
 _VERSION_NOTICE = """dl210th client 0.1
 Copyright (C) 2024 Tomasz Malesinski
@@ -28,6 +28,11 @@ There is NO WARRANTY, to the extent permitted by law."""
 
 _TIMEOUT = 1000
 
+# Report id (0x3f), length of the command and payload, command.
+_COMMAND_HEADER = struct.Struct("BBB")
+# Report id (0x3f), length of the response data.
+_RESPONSE_HEADER = struct.Struct("BB")
+
 class DlError(Exception):
     pass
 
@@ -37,166 +42,175 @@ class UserError(DlError):
 
 
 class _Field(object):
+    value_count = 1
+
     def __init__(self, name):
         self.name = name
 
-    def parse(self, data, i):
-        sl = self.serialized_length()
-        if i + sl > len(data):
-            raise DlError("record too short")
-        return self._parse_internal(data, i), i + sl
+    def from_values(self, values, i):
+        return values[i]
+
+    def to_values(self, v):
+        return (v,)
 
 
 class _Byte(_Field):
+    struct_format = "B"
+
     def initial_value(self):
         return 0
 
-    def serialized_length(self):
-        return 1
-
-    def _parse_internal(self, data, i):
-        return data[i]
-
-    def serialize(self, v):
-        return bytes([v])
-
 
 class _Word(_Field):
+    struct_format = "H"
+
     def initial_value(self):
         return 0
 
-    def serialized_length(self):
-        return 2
-
-    def _parse_internal(self, data, i):
-        return data[i] + (data[i + 1] << 8)
-
-    def serialize(self, v):
-        return bytes([v & 0xff, v >> 8])
-
 
 class _SWord(_Field):
+    struct_format = "h"
+
     def initial_value(self):
         return 0
 
-    def serialized_length(self):
-        return 2
-
-    def _parse_internal(self, data, i):
-        v = data[i] + (data[i + 1] << 8)
-        if v & 0x8000:
-            v -= 0x10000
-        return v
-
-    def serialize(self, v):
-        if v < 0:
-            v += 0x10000
-        return bytes([v & 0xff, v >> 8])
-
 
 class _Long(_Field):
+    struct_format = "I"
+
     def initial_value(self):
         return 0
 
-    def serialized_length(self):
-        return 4
-
-    def _parse_internal(self, data, i):
-        v = 0
-        for j in range(4):
-            v = v + (data[i + j] << (j * 8))
-        return v
-
-    def serialize(self, v):
-        return bytes([(v >> (i * 8)) & 0xff for i in range(4)])
-
 
 class _String(_Field):
     def __init__(self, name, length):
         super().__init__(name)
         self.length = length
+        self.struct_format = "%ds" % length
 
     def initial_value(self):
         return bytes()
 
-    def serialized_length(self):
-        return self.length
-
-    def _parse_internal(self, data, i):
-        return data[i:i + self.length]
-
-    def serialize(self, v):
-        return v + bytes(max(0, self.length - len(v)))
-
 
 class _Subrecord(_Field):
     def __init__(self, name, cls):
         super().__init__(name)
         self.cls = cls
+        # The nested record is inlined into the parent's struct format.
+        self.struct_format = cls._struct_format
+        self.value_count = cls._value_count
 
     def initial_value(self):
         return self.cls()
 
-    def serialized_length(self):
-        return self.cls.serialized_length()
+    def from_values(self, values, i):
+        return self.cls._from_values(values, i)
+
+    def to_values(self, v):
+        return v._to_values()
 
-    def _parse_internal(self, data, i):
-        return self.cls._parse_internal(data, i)[1]
 
-    def serialize(self, v):
-        return v.serialize()
+class _BinaryRecordMeta(type):
+    def __new__(mcs, name, bases, namespace, **kwargs):
+        # __slots__ must be present when the class is created, so it
+        # can't be added later in __init_subclass__.
+        namespace["__slots__"] = tuple(
+            f.name for f in namespace.get("_fields", ()))
+        return super().__new__(mcs, name, bases, namespace, **kwargs)
 
 
-class _BinaryRecord(object):
+class _BinaryRecord(object, metaclass=_BinaryRecordMeta):
     def __init__(self, **kwargs):
-        for f in self._fields:
-            v = kwargs[f.name] if f.name in kwargs else f.initial_value()
-            setattr(self, f.name, v)
+        for name, v in self._initial_values:
+            if name in kwargs:
+                v = kwargs[name]
+            elif isinstance(v, _BinaryRecord):
+                # Nested records are mutable, don't share the default.
+                v = v.__class__()
+            setattr(self, name, v)
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._struct_format = "".join(f.struct_format for f in cls._fields)
+        cls._struct = struct.Struct("<" + cls._struct_format)
+        cls._serialized_length = cls._struct.size
+        cls._value_count = sum(f.value_count for f in cls._fields)
+        cls._field_names = tuple(f.name for f in cls._fields)
+        cls._initial_values = tuple(
+            (f.name, f.initial_value()) for f in cls._fields)
+        cls._has_subrecords = any(
+            isinstance(f, _Subrecord) for f in cls._fields)
+        cls._repr_format = "<%s %s>" % (
+            cls.__name__,
+            ", ".join("%s=%%r" % name for name in cls._field_names))
 
     @classmethod
-    def _parse_internal(cls, data, i):
-        record = cls()
-        for f in cls._fields:
-            v, i1 = f.parse(data, i)
-            setattr(record, f.name, v)
-            i = i1
-        return i1, record
-        
+    def _from_values(cls, values, i=0):
+        record = cls.__new__(cls)
+        if cls._has_subrecords:
+            for f in cls._fields:
+                setattr(record, f.name, f.from_values(values, i))
+                i += f.value_count
+        else:
+            if i:
+                values = values[i:i + cls._value_count]
+            for name, v in zip(cls._field_names, values):
+                setattr(record, name, v)
+        return record
+
     @classmethod
-    def parse(cls, data):
-        i, record = cls._parse_internal(data, 0)
-        if i < len(data):
+    def parse(cls, data, offset=0):
+        # Parsing from an offset lets callers skip response headers
+        # without copying the rest of the response.
+        try:
+            values = cls._struct.unpack_from(data, offset)
+        except struct.error:
+            raise DlError("record too short")
+        if offset + cls._serialized_length < len(data):
             raise DlError("record too long")
-        return record
-        
-    def serialize(self): 
-        res = bytes()
+        return cls._from_values(values)
+
+    # Parses consecutive records filling data from offset to the end.
+    @classmethod
+    def parse_array(cls, data, offset=0):
+        try:
+            it = cls._struct.iter_unpack(memoryview(data)[offset:])
+        except struct.error:
+            raise DlError("data length not a multiple of record length")
+        return [cls._from_values(values) for values in it]
+
+    def _to_values(self):
+        if not self._has_subrecords:
+            return [getattr(self, name) for name in self._field_names]
+        values = []
         for f in self._fields:
-            res += f.serialize(getattr(self, f.name))
-        return res
+            values.extend(f.to_values(getattr(self, f.name)))
+        return values
+
+    def serialize(self):
+        try:
+            return self._struct.pack(*self._to_values())
+        except struct.error as e:
+            raise ValueError("cannot serialize %s: %s"
+                             % (self.__class__.__name__, e))
 
     @classmethod
     def serialized_length(cls):
-        res = 0
-        for f in cls._fields:
-            res += f.serialized_length()
-        return res
+        return cls._serialized_length
 
-    def __setattr__(self, name, value):
-        if not any([f.name == name for f in self._fields]):
-            raise KeyError("unknown field " + name)
-        object.__setattr__(self, name, value)
+    def __eq__(self, other):
+        if type(self) is not type(other):
+            return NotImplemented
+        return self._to_values() == other._to_values()
 
     def __repr__(self):
-        res = "<%s " % self.__class__.__name__
-        res += ", ".join(
-            ["%s=%s" % (f.name, repr(getattr(self, f.name)))
-             for f in self._fields])
-        res += ">"
-        return res
+        return self._repr_format % tuple(
+            getattr(self, name) for name in self._field_names)
 
 
 class DataBlock:
+    __slots__ = ("num", "measurements")
+
     def __init__(self, num, measurements):
         self.num = num
         self.measurements = measurements
@@ -210,11 +224,16 @@ def open_hid_dev():
 class _DlHidConnection:
     def __init__(self, dev):
         self._dev = dev
+        self._send_buffer = bytearray(64)
 
     def send_command(self, command, payload=bytes()):
-        # TODO: check if payload not too long?
-        buf = bytes([0x3f, len(payload) + 1, command]) + payload
-        self._dev.write(buf)
+        buf = self._send_buffer
+        n = _COMMAND_HEADER.size + len(payload)
+        if n > len(buf):
+            raise ValueError("payload too long (%d bytes)" % len(payload))
+        _COMMAND_HEADER.pack_into(buf, 0, 0x3f, len(payload) + 1, command)
+        buf[_COMMAND_HEADER.size:n] = payload
+        self._dev.write(memoryview(buf)[:n])
 
     def read_response(self):
         return bytes(self._dev.read(64, _TIMEOUT))
@@ -223,13 +242,22 @@ class _DlHidConnection:
         self.send_command(command, payload)
         response = self.read_response()
         # TODO: what is returned on error, timeout?
-        if len(response) < 2:
-            raise DlError("response too short (%d bytes)", len(response))
-        if response[0] != 0x3f:
-            raise DlError("invalid first byte (0x%02x)", response[0])
-        if response[1] + 2 > len(response):
-            raise DlError("response length too large (%d)", response[1])
-        return response[2:response[1] + 2]
+        length = _check_response_header(response)
+        return response[2:length + 2]
+
+
+# Validates the report header and returns the length of the response data
+# following it.
+def _check_response_header(response):
+    try:
+        report_id, length = _RESPONSE_HEADER.unpack_from(response)
+    except struct.error:
+        raise DlError("response too short (%d bytes)" % len(response))
+    if report_id != 0x3f:
+        raise DlError("invalid first byte (0x%02x)" % report_id)
+    if length + 2 > len(response):
+        raise DlError("response length too large (%d)" % length)
+    return length
 
 
 def _get_string(bytes):
@@ -336,7 +364,7 @@ class OwnerStartTime(_BinaryRecord):
 def _check_response(response, length=None, prefix=None):
     if length is not None and len(response) != length:
         raise DlError("expected %d bytes, got %d" % (length, len(response)))
-    if prefix is not None and not response.startswith(bytes(prefix)):
+    if prefix is not None and not response.startswith(prefix):
         raise DlError("invalid response start: %s" % response[0:len(prefix)])
 
 
@@ -351,30 +379,30 @@ class Dl210Th(object):
 
     def status(self):
         response = self._connection.run_command(48)
-        _check_response(response, length=60, prefix=[48])
-        return StatusRecord.parse(response[1:])
+        _check_response(response, length=60, prefix=b"\x30")
+        return StatusRecord.parse(response, 1)
 
     def record_basic(self, basic_config):
         if not isinstance(basic_config, BasicConfig):
             raise ValueError("BasicConfig expected")
         response = self._connection.run_command(3, basic_config.serialize())
-        _check_response(response, length=3, prefix=[0, 0, 3])
+        _check_response(response, length=3, prefix=b"\x00\x00\x03")
 
     def record_full(self, logger_config):
         if not isinstance(logger_config, LoggerConfig):
             raise ValueError("LoggerConfig expected")
         response = self._connection.run_command(17, logger_config.serialize())
-        _check_response(response, length=3, prefix=[0, 0, 17])
+        _check_response(response, length=3, prefix=b"\x00\x00\x11")
 
     def get_basic_config(self):
         response = self._connection.run_command(4)
-        _check_response(response, length=31, prefix=[0, 0, 4])
-        return BasicConfig.parse(response[3:])
+        _check_response(response, length=31, prefix=b"\x00\x00\x04")
+        return BasicConfig.parse(response, 3)
 
     def read_sensors(self):
         response = self._connection.run_command(6)
-        _check_response(response, length=7, prefix=[0, 0, 6])
-        return Measurement.parse(response[3:])
+        _check_response(response, length=7, prefix=b"\x00\x00\x06")
+        return Measurement.parse(response, 3)
 
     def get_serial_id(self):
         response = self._connection.run_command(12)
@@ -383,50 +411,45 @@ class Dl210Th(object):
 
     def get_logger_config(self):
         response = self._connection.run_command(33)
-        _check_response(response, length=60, prefix=[33])
-        return LoggerConfig.parse(response[1:])
+        _check_response(response, length=60, prefix=b"\x21")
+        return LoggerConfig.parse(response, 1)
         
     def get_settings34(self):
         response = self._connection.run_command(34)
-        _check_response(response, length=56, prefix=[34])
+        _check_response(response, length=56, prefix=b"\x22")
         return response[1:]
         
     def get_owner_start_time(self):
         response = self._connection.run_command(35)
-        _check_response(response, length=40, prefix=[35])
-        return OwnerStartTime.parse(response[1:])
+        _check_response(response, length=40, prefix=b"\x23")
+        return OwnerStartTime.parse(response, 1)
 
     def get_location(self):
         response = self._connection.run_command(36)
-        _check_response(response, length=33, prefix=[36])
+        _check_response(response, length=33, prefix=b"\x24")
         return response[1:]
 
     def get_report_title(self):
         response = self._connection.run_command(37)
-        _check_response(response, length=41, prefix=[37])
+        _check_response(response, length=41, prefix=b"\x25")
         return response[1:]
 
     def get_user_text1(self):
         response = self._connection.run_command(38)
-        _check_response(response, length=51, prefix=[38])
+        _check_response(response, length=51, prefix=b"\x26")
         return response[1:]
 
     def get_user_text2(self):
         response = self._connection.run_command(39)
-        _check_response(response, length=21, prefix=[39])
+        _check_response(response, length=21, prefix=b"\x27")
         return response[1:]
 
     def _decode_block(self, encoded):
         num = (encoded[0] << 8) + encoded[1]
-        block = DataBlock(num, [])
-        for n in range((len(encoded) - 2) // 4):
-            i = 2 + 4 * n
-            block.measurements.append(Measurement.parse(encoded[i:i + 4]))
-        return block
+        return DataBlock(num, Measurement.parse_array(encoded, 2))
 
     def get_data_block(self, n):
-        # TODO: check that n fits in 16 bits?
-        req = bytes([n >> 8, n & 0xff])
+        req = n.to_bytes(2, "big")
         response = self._connection.run_command(2, payload=req)
         _check_response(response, prefix=req)
         if len(response) < 2:
@@ -445,36 +468,36 @@ class Dl210Th(object):
         while True:
             r = self._connection.read_response()
             if not r: break
-            # TODO: the same is in run_command
-            if len(r) < 2:
-                raise DlError("response too short: %d" % len(r))
-            if r[0] != 0x3f:
-                raise DlError("invalid first response byte: %d" % r[0])
-            # TODO: check if there is enough bytes in the response?
-            l = r[1]
+            l = _check_response_header(r)
             if l < 2: raise DlError("too short block")
-            if l > len(r) - 2: raise DlError("number of data bytes too big")
             # TODO: when do we get empty responses? when stopped?
             if l == 2: continue
             if l == 3:
-                if r[2:].startswith(bytes([0, 0, 5])):
+                if r.startswith(b"\x00\x00\x05", 2):
                     break
-                print("unexpected three byte response: %s" % list(r[0:5]))
+                print("unexpected three byte response: %s" % list(r[0:5]),
+                      file=sys.stderr)
                 break
             if (l - 2) % 4 != 0:
                 raise DlError("expected number of data bytes divisible by 4, "
                               "got %d" % (l - 2))
-            block = self._decode_block(r[2:2 + l])
+            block = self._decode_block(memoryview(r)[2:2 + l])
             if n != block.num:
-                print("Unexpected block num: %d vs %d" % (block.num, n))
+                print("Unexpected block num: %d vs %d" % (block.num, n),
+                      file=sys.stderr)
             n = block.num + 1
             data.append(block)
         return data
 
 
-def _try_read_measurements(dl):
-    config_before = dl.get_basic_config()
-    owner_before = dl.get_owner_start_time()
+# TODO: with two requests we can have inconsistent data_count and start_time
+# does it matter? Can we somehow read the two in a way that ensures
+# consistency?
+def _read_logger_state(dl):
+    return dl.get_basic_config(), dl.get_owner_start_time()
+
+
+def _try_read_measurements(dl, config_before):
     blocks = dl.dump_data()
 
     per_block = 15
@@ -495,28 +518,27 @@ def _try_read_measurements(dl):
     # TODO: check if there is expected number of entries in total? or not?
     for i, b in enumerate(result):
         exp_len = expected_in_last if i == expected_blocks - 1 else per_block
-        if b is None or len(b.measurements) < per_block:
+        if b is None or len(b.measurements) < exp_len:
             result[i] = dl.get_data_block(i + 1)
 
-    # TODO: with two requests we can have inconsistent data_count and start_time
-    # does it matter? Can we somehow read the two in a way that ensures
-    # consistency?
-    config_after = dl.get_basic_config()
-    owner_after = dl.get_owner_start_time()
-
-    # TODO: handle invalid start dates?
-    if ((config_before.data_count != config_after.data_count) or
-        (owner_before.start_time.to_datetime() !=
-         owner_after.start_time.to_datetime())):
-        raise DlError(f"data item added while dumping")
-
-    return result, config_after, owner_after.start_time
+    return result
 
 def read_measurements(dl):
     num_retries = 5
+    state = None
     while True:
         try:
-            blocks, config, start_time = _try_read_measurements(dl)
+            if state is None:
+                state = _read_logger_state(dl)
+            config_before, owner_before = state
+            blocks = _try_read_measurements(dl, config_before)
+            config, owner = _read_logger_state(dl)
+            if ((config_before.data_count != config.data_count) or
+                (owner_before.start_time != owner.start_time)):
+                # This state was read after the dump, so it is also a
+                # valid starting state for the next attempt.
+                state = config, owner
+                raise DlError(f"data item added while dumping")
         except DlError as e:
             num_retries -= 1
             if num_retries >= 0:
@@ -525,14 +547,18 @@ def read_measurements(dl):
         else:
             break
 
-    time = start_time.to_datetime()
+    # TODO: handle invalid start dates?
+    time = owner.start_time.to_datetime()
     sample_rate = datetime.timedelta(seconds=config.sample_rate)
-    print("time,temperature,humidity")
+    lines = ["time,temperature,humidity\n"]
     for b in blocks:
         for m in b.measurements:
-            print(time.strftime("%Y-%m-%d %H:%M:%S") +
-                  f",{m.temperature100 / 100},{m.humidity100 / 100}")
+            # Same as strftime("%Y-%m-%d %H:%M:%S"), but without parsing
+            # the format string for every sample.
+            lines.append(time.isoformat(" ", "seconds") +
+                         f",{m.temperature100 / 100},{m.humidity100 / 100}\n")
             time += sample_rate
+    sys.stdout.write("".join(lines))
 
 
 def create_parser():